@@ -1,15 +1,19 @@
 import io
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests, colorgram, os, platform
 import time
-import spotipy.util as util
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-from spotipy.oauth2 import SpotifyOAuth
-import random, json
-from cachetools import TTLCache
 import math
-from urllib.parse import urlencode
+import stat
+import shutil
+import tempfile
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageStat
+from requests.adapters import HTTPAdapter
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
+import random
+import orjson
+from cachetools import TTLCache
 from PIL import Image
 from cairosvg import svg2png
 from lxml import etree
@@ -20,6 +24,8 @@ global spotify_token, client_id, client_secret, username, display, original_wall
 client_id = ""
 client_secret = ""
 spotify_token = ""
+spotify_oauth = None
+token_info = None
 username = ""
 scope = "user-read-currently-playing"
 display = ""
@@ -35,6 +41,33 @@ availableEnvironment = [
 
 
 cache = TTLCache(maxsize=100, ttl=3600)
+#palettes already extracted from the album images, indexed by image URL
+colors_cache = TTLCache(maxsize=100, ttl=3600)
+
+#shared HTTP session: keeps the connections to Spotify alive between requests, avoiding a new TCP+TLS handshake each time
+#one pool per host: the Spotify API and the image CDN
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
+
+#worker threads used to run independent network requests concurrently
+executor = ThreadPoolExecutor(max_workers=2)
+
+#ETag and parsed body of the last currently-playing response, used for conditional requests
+last_etag = None
+last_song_content = None
+
+#fonts already loaded from disk, indexed by size
+font_cache = {}
+
+#full-display canvases reused between wallpapers, indexed by (mode, width, height)
+canvas_cache = {}
+
+#the final wallpaper is rewritten at every song change, so keep it in the runtime directory (tmpfs) instead of on disk;
+#both paths are set by setup_runtime_dir()
+runtime_dir = ""
+final_image_path = ""
+#True when runtime_dir is a temporary directory created for this run, to be removed on exit
+runtime_dir_is_temporary = False
 
 
 #check if gnome is in dark mode or light mode
@@ -58,113 +91,41 @@ def getEnvironment():
             environment, command = env['envName'], env['command']
             break
 
-def get_token_refresh():
+def token_refresh():
     """
-    Get the Spotify refresh token from the cache file
+    Refresh the Spotify token using the refresh token kept in memory
 
     Returns:
-        str: The Spotify refresh token
-    """
-    filename = f".cache-{username}"
-    try:
-        with open(filename, 'r') as file:
-            data = json.load(file)
-            return data['refresh_token']
-    except:
-        return None
-    
-
-def write_token_refresh(refresh_token):
+        str: The new Spotify token
     """
-    Write the Spotify refresh token to the cache file
+    global spotify_token, token_info
 
-    Args:
-        refresh_token (str): The Spotify refresh token to write to the cache file
-
-    Returns:
-        None: The Spotify refresh token is written to the cache file
-    """
-    filename = f".cache-{username}"
-    try:
-        with open(filename, 'r') as file:
-            data = json.load(file)
-            data['refresh_token'] = refresh_token
-            with open(filename, 'w') as file:
-                json.dump(data, file)
-    except:
-        return None
-    
+    if token_info and token_info.get('refresh_token'):
+        try:
+            # The new token is also written to the cache file by spotipy
+            token_info = spotify_oauth.refresh_access_token(token_info['refresh_token'])
+            spotify_token = token_info['access_token']
+            return spotify_token
+        except SpotifyOauthError as e:
+            print("Failed to refresh the token:", e)
+            print("Trying to authenticate again")
+    else:
+        print("No refresh token found, trying to authenticate again")
 
-def write_token(spotify_token):
-    """
-    Write the Spotify token to the cache
-    
-    Args:
-        spotify_token (str): The Spotify token to write to the cache file
-        
-    Returns:
-        None: The Spotify token is written to the cache file"""
-    filename = f".cache-{username}"
-    try:
-        with open(filename, 'r') as file:
-            data = json.load(file)
-            data['access_token'] = spotify_token
-            with open(filename, 'w') as file:
-                json.dump(data, file)
-    except:
-        return None
+    spotify_authenticate()
+    return spotify_token
 
 
-def token_refresh():
+def ensure_token():
     """
-    Refresh the Spotify token using the refresh token
+    Refresh the Spotify token only if it is expired or about to expire
 
     Returns:
-        str: The new Spotify token
+        str: A valid Spotify token
     """
-    refresh_token = get_token_refresh()
-    url = "https://accounts.spotify.com/api/token"
-
-    if refresh_token:
-        payload = {
-        'grant_type': 'refresh_token',
-        'refresh_token': refresh_token,
-        'client_id': client_id
-        }
-
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-
-        response = requests.post(url, headers=headers, data=urlencode(payload))
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Extract the new access and refresh tokens from the response
-            response_data = response.json()
-            spotify_token = response_data.get('access_token')
-            new_refresh_token = response_data.get('refresh_token', refresh_token)  # Use the same refresh token if a new one isn't provided
-
-            # Here you would update your storage mechanism with the new tokens
-            # Since Python scripts don't have direct access to browser's localStorage,
-            # you need to adapt this part to your application's environment.
-            print("New access token:", spotify_token)
-            print("New refresh token:", new_refresh_token)
-
-            # Write the new tokens to the cache
-            write_token(spotify_token)
-            write_token_refresh(new_refresh_token)
-
-            return spotify_token
-
-            
-        else:
-            print("Failed to refresh the token, status code:", response.status_code)
-            print("Trying to authenticate again")
-            spotify_authenticate()
-            return 
-    else:
-        print("No refresh token found, trying to authenticate again")
-        spotify_authenticate()
-        return
+    if token_info is None or spotify_oauth.is_token_expired(token_info):
+        return token_refresh()
+    return spotify_token
 
 
 def  init():
@@ -188,6 +149,9 @@ def  init():
     if not os.path.exists("ImageCache"):
         os.mkdir("ImageCache")
 
+    #create the runtime directory where the final wallpaper is written
+    setup_runtime_dir()
+
     # Declare global variables to be used in other functions
     global client_secret, colors, client_id, username, display
 
@@ -208,19 +172,60 @@ def  init():
 def spotify_authenticate():
     """
     Authenticate with the Spotify API using the credentials from the creds.txt file.
+    The cached token is used if available; otherwise the authorization link is printed, without opening a browser.
     The authentication token is stored in the global variable spotify_token.
     """
     # Get the Spotify access token for authentication
-    global spotify_token
-    token = util.prompt_for_user_token(username, scope, client_id, client_secret, "https://www.google.com/")
-    if token:
-        spotify_token = token
+    global spotify_token, spotify_oauth, token_info
+    if spotify_oauth is None:
+        spotify_oauth = SpotifyOAuth(client_id=client_id, client_secret=client_secret, redirect_uri="https://www.google.com/", scope=scope, cache_path=f".cache-{username}", open_browser=False)
+
+    try:
+        token_info = spotify_oauth.validate_token(spotify_oauth.cache_handler.get_cached_token())
+    except SpotifyOauthError:
+        # The cached refresh token has been revoked or is invalid
+        token_info = None
+    if token_info is None:
+        # No valid token in the cache: ask the user to log in and paste the redirect URL
+        spotify_oauth.get_access_token(spotify_oauth.get_auth_response(), as_dict=False, check_cache=False)
+        token_info = spotify_oauth.cache_handler.get_cached_token()
+
+    if token_info:
+        spotify_token = token_info['access_token']
     else:
         print("Couldn't get proper Spotify authentication")
         exit()
 
 
 
+def setup_runtime_dir():
+    """
+    Create the private directory where the final wallpaper is written.
+    It lives in $XDG_RUNTIME_DIR when available; otherwise a new directory is created in the temporary directory,
+    so other users can't create it first or plant files in it.
+
+    Returns:
+        None: the directory and the wallpaper path are stored in global variables
+    """
+    global runtime_dir, final_image_path, runtime_dir_is_temporary
+
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        runtime_dir = os.path.join(os.environ["XDG_RUNTIME_DIR"], "spotifysyncwall")
+        os.makedirs(runtime_dir, mode=0o700, exist_ok=True)
+
+        #make sure the directory really belongs to the current user, and is not a symlink
+        info = os.lstat(runtime_dir)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            print(f"{runtime_dir} is not a directory owned by the current user")
+            exit()
+    else:
+        runtime_dir = tempfile.mkdtemp(prefix="spotifysyncwall-")
+        runtime_dir_is_temporary = True
+
+    final_image_path = os.path.join(runtime_dir, "finalImage.png")
+
+
+
 def get_variables():
     """
     Get the variables from the creds.txt file.
@@ -263,7 +268,7 @@ def download_image(image_url):
         return cache[image_url]
     
     try: 
-        response = requests.get(image_url)
+        response = session.get(image_url, timeout=10)
         response.raise_for_status()  # Check if the request was successful
 
         # Cache the image data
@@ -280,31 +285,66 @@ def download_image(image_url):
         return None
 
 
-def get_song_details(spotify_token, retry_delay=2, max_retries=3):
+def select_image_url(images, targetWidth):
+    """
+    Choose the smallest album image that is at least as wide as the target width,
+    so that less data is downloaded and resized.
+
+    Args:
+        images (list): The album images returned by the Spotify API.
+        targetWidth (int): The width the album image will be drawn at.
+
+    Returns:
+        str or None: The URL of the chosen image, or None if there are no images.
+    """
+    if not images:
+        return None
+
+    # Spotify lists the images from the largest to the smallest; fall back to the largest one
+    largeEnough = [image for image in images if (image.get('width') or 0) >= targetWidth]
+    if largeEnough:
+        return min(largeEnough, key=lambda image: image.get('width')).get('url')
+    return max(images, key=lambda image: image.get('width') or 0).get('url')
+
+
+def get_song_details(spotify_token, retry_delay=2, max_retries=3, coverWidth=None):
     """
     Fetches and downloads details of the currently playing song from Spotify, including downloading the cover image.
     
     Args:
         spotify_token (str): Spotify API token.
-        retry_delay (int): Time in seconds to wait before retries.
+        retry_delay (int): Time in seconds to wait before retries; after request errors and server errors it doubles at every attempt.
         max_retries (int): Maximum number of retries for the request.
+        coverWidth (int): The width the album image will be drawn at; defaults to the width used by setup_album_image.
     
     Returns:
         tuple or None: Returns a tuple with song details (name, status, local image path, artistName, songId)
                        or None if the request fails or data is incomplete.
     """
-    header = {"Authorization": f"Bearer {spotify_token}"}
+    global last_etag, last_song_content
+    header = {"Accept": "application/json", "Authorization": f"Bearer {spotify_token}"}
     url = "https://api.spotify.com/v1/me/player/currently-playing"
 
     for attempt in range(max_retries):
+        # Exponential backoff on failures, so transient outages are not hammered with requests;
+        # no need to wait after the last attempt
+        lastAttempt = attempt == max_retries - 1
+        backoff = 0 if lastAttempt else retry_delay * (2 ** attempt)
+        delay = 0 if lastAttempt else retry_delay
         try:
-            response = requests.get(url, headers=header)
+            # Ask Spotify to skip the body if nothing changed since the last response
+            if last_etag and last_song_content is not None:
+                header["If-None-Match"] = last_etag
+            else:
+                header.pop("If-None-Match", None)
+
+            response = session.get(url, headers=header, timeout=10)
             status = int(response.status_code)
-            song_content = response.json()
 
             if status == 401:
                 # Token has expired, reauthenticate
                 spotify_token = token_refresh()
+                header["Authorization"] = f"Bearer {spotify_token}"
                 print("Token refreshed")
                 
                 continue
@@ -315,24 +355,40 @@ def get_song_details(spotify_token, retry_delay=2, max_retries=3):
                 time.sleep(retry_after)
                 continue
 
+            if status >= 500:
+                # Spotify is having problems, back off before trying again
+                time.sleep(backoff)
+                continue
+
+            if status == 304:
+                # Nothing changed, reuse the last parsed response
+                song_content = last_song_content
+            else:
+                # Parse the raw bytes directly; the body is empty when nothing is playing (204)
+                song_content = orjson.loads(response.content) if response.content else {}
+                if status == 200:
+                    last_etag = response.headers.get("ETag")
+                    last_song_content = song_content
+
             # Check if the response has the necessary information
             if 'item' not in song_content or not song_content['item']:
                 #print("No song information found. Retrying...")
-                time.sleep(retry_delay)
+                time.sleep(delay)
                 continue
 
             status = "paused" if 'is_playing' not in song_content or not song_content['is_playing'] else "playing"
             item = song_content['item']
             name = item.get('name')
             artistName = item['album']['artists'][0].get('name')
-            imageUrl = item['album']['images'][0].get('url')  # Using the first image (usually the largest)
+            # Using the smallest image that still covers the album image width on the wallpaper
+            imageUrl = select_image_url(item['album']['images'], coverWidth if coverWidth is not None else int(int(display[0]) / 5))
             songId = item.get('id')
             songLength = item.get('duration_ms')
 
 
             if not all([name, artistName, imageUrl, songId]):
                 print("Incomplete song information. Retrying...")
-                time.sleep(retry_delay)
+                time.sleep(delay)
                 continue
 
             return name, status, imageUrl, artistName, songId, songLength
@@ -340,10 +396,10 @@ def get_song_details(spotify_token, retry_delay=2, max_retries=3):
         except requests.exceptions.RequestException as e:
             #print(f"Request failed: {e}. Retrying in {retry_delay} seconds...")
              
-            time.sleep(retry_delay)
-        except KeyError as e:
+            time.sleep(backoff)
+        except (KeyError, orjson.JSONDecodeError) as e:
             #print(f"Missing expected data: {e}. Retrying...")
-            time.sleep(retry_delay)  
+            time.sleep(delay)
 
     print("Maximum retries reached. Exiting function.")
     return None
@@ -362,12 +418,9 @@ def create_color_background(baseWidth, baseHeight, colors):
         
     Returns:
         Image: A new background image with two colors."""
-    colorImageOne = Image.new('RGB', (baseWidth, int(baseHeight / 2)), colors[0].rgb)
-    colorImageTwo = Image.new('RGB', (baseWidth, int(baseHeight / 2)), colors[1].rgb)
-
-    background = Image.new('RGB', (colorImageOne.width, colorImageOne.height + colorImageTwo.height))
-    background.paste(colorImageOne, (0, 0))
-    background.paste(colorImageTwo, (0, colorImageOne.height))
+    background = get_canvas('RGB', baseWidth, baseHeight, colors[0].rgb)
+    # The second color fills the bottom half, taking the remaining row when the height is odd
+    background.paste(colors[1].rgb, (0, int(baseHeight / 2), baseWidth, baseHeight))
 
     return background
 
@@ -384,11 +437,11 @@ def albumImage(display, songTitle, artistName, imageUrl):
     Returns:
         None: The generated wallpaper is saved to the 'ImageCache' directory."""
     image = setup_album_image(display, imageUrl)
-    text = generate_text_image(songTitle, artistName, getColors(imageUrl), display)
 
     background = create_color_background(int(display[0]), int(display[1]), getColors(imageUrl))
+    text, textPosition = generate_text_image(songTitle, artistName, background)
 
-    paste_and_save_album_image(background, image, display, text)
+    paste_and_save_album_image(background, image, display, text, textPosition)
     
 
 
@@ -407,11 +460,16 @@ def calculate_relative_luminance(color):
     # Calculate relative luminance using the specified formula
     return 0.2126 * r + 0.7152 * g + 0.0722 * b
 
-def calculate_contrast_ratio(color1, color2):
-    # Calculate relative luminance for both colors
-    luminance1 = calculate_relative_luminance(color1)
-    luminance2 = calculate_relative_luminance(color2)
+def calculate_contrast_ratio(luminance1, luminance2):
+    """
+    Calculate the contrast ratio between two already computed relative luminances.
 
+    Args:
+        luminance1 (float): The relative luminance of the first color.
+        luminance2 (float): The relative luminance of the second color.
+
+    Returns:
+        float: The contrast ratio between the two luminances."""
     # Ensure that the lighter color's luminance is in luminance1
     if luminance2 > luminance1:
         luminance1, luminance2 = luminance2, luminance1
@@ -422,29 +480,40 @@ def calculate_contrast_ratio(color1, color2):
 def getColors(imageUrl):
     """
     Get the two most prominent colors from the album image.
+    The palette is extracted only once for each image, and then cached.
     
     Returns:
         list: A list of two color objects extracted from the album image.
         """
     
+    if imageUrl in colors_cache:
+        return colors_cache[imageUrl]
+
     #retrieve the image from the cache
     image = get_image_from_cache(imageUrl)
     image = Image.open(io.BytesIO(image))
     # Setup Background Colors
-    colors = colorgram.extract('ImageCache/albumImage.png', 13)
+    colors = colorgram.extract(image, 13)
 
     if len(colors) < 2:
         # In this case, the function will return
-        return [colors[0], colors[0]]
+        colors_cache[imageUrl] = [colors[0], colors[0]]
+        return colors_cache[imageUrl]
+
+    # Compute the luminance of the whole palette once, instead of once per comparison
+    luminances = [calculate_relative_luminance(color) for color in colors]
 
     # Check if colors are too similar
     for i in range(1, len(colors)):
-        if calculate_contrast_ratio(colors[0], colors[i]) >= 2:
+        if calculate_contrast_ratio(luminances[0], luminances[i]) >= 2:
             # Colors are different enough, so return them
-            return [colors[0], colors[i]]
+            colors_cache[imageUrl] = [colors[0], colors[i]]
+            break
     else:
-        return [colors[0], colors[1]]
-    # For loop will end only if we run out of colors, so return the first two
+        # For loop will end only if we run out of colors, so return the first two
+        colors_cache[imageUrl] = [colors[0], colors[1]]
+
+    return colors_cache[imageUrl]
 
 
 def checkSong():
@@ -504,6 +573,47 @@ def setup_album_image(display, imageUrl):
     return image
 
 
+def get_font(size=40):
+    """
+    Get the Rubik font with the given size, loading it from disk only the first time.
+
+    Args:
+        size (int): The size of the font.
+
+    Returns:
+        FreeTypeFont: The font object.
+    """
+    font = font_cache.get(size)
+    if font is None:
+        font = font_cache[size] = ImageFont.truetype("./fonts/Rubik.ttf", size)
+    return font
+
+
+def get_canvas(mode, width, height, color = (0, 0, 0)):
+    """
+    Get a canvas with the given mode and dimensions, filled with the given color.
+    The display never changes while the script is running, so the same canvas is reused
+    for every wallpaper instead of allocating a new one each time.
+    The canvas is overwritten by the next call: it is only meant to be used by the thread generating the wallpapers.
+
+    Args:
+        mode (str): The mode of the image (e.g. 'RGB' or 'RGBA').
+        width (int): The width of the canvas.
+        height (int): The height of the canvas.
+        color (tuple): The color used to clear the canvas.
+
+    Returns:
+        Image: The canvas, filled with the given color.
+    """
+    key = (mode, width, height)
+    canvas = canvas_cache.get(key)
+    if canvas is None:
+        canvas = canvas_cache[key] = Image.new(mode, (width, height), color)
+    else:
+        canvas.paste(color, (0, 0, width, height))
+    return canvas
+
+
 def generate_gradient_image(colors, display):
     """
     Generate a gradient image based on the colors of the album image.
@@ -518,7 +628,7 @@ def generate_gradient_image(colors, display):
     # Create a gradient image with the colors of the album image
     width = int(display[0])
     height = int(display[1])
-    gradient = Image.new('RGB', (width, height))
+    gradient = get_canvas('RGB', width, height)
 
     # Create a draw object
     draw = ImageDraw.Draw(gradient)
@@ -537,103 +647,145 @@ def generate_gradient_image(colors, display):
 
 
 
-def generate_text_image(songTitle, artistName, colors, display, positionX = 50, positionY = 50):
+def get_text_color(background, box):
+    """
+    Choose black or white text, depending on how light the background under the text actually is.
+    The mean is computed on the L conversion of the region, so it uses the same fixed-point Rec.601 luma as Pillow.
+
+    Args:
+        background (Image): The image the text will be pasted on.
+        box (tuple): The (left, upper, right, lower) region covered by the text.
+
+    Returns:
+        tuple: Black if the region is too light, white otherwise.
+    """
+    # Keep the region inside the background, so the crop is not padded with black
+    box = (max(0, box[0]), max(0, box[1]), min(background.width, box[2]), min(background.height, box[3]))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return (255, 255, 255)
+
+    region = background.crop(box).convert('L')
+    if ImageStat.Stat(region).mean[0] > 160:
+        return (0, 0, 0)
+    return (255, 255, 255)
+
+
+def measure_text(content, align = "left"):
+    """
+    Measure the given text, written with the Rubik font at size 40 used for the song details.
+
+    Args:
+        content (str): The text to measure.
+        align (str): The alignment of the lines.
+
+    Returns:
+        tuple: The (left, upper, right, lower) bounding box of the text, when drawn at (0, 0).
+    """
+    left, top, right, bottom = ImageDraw.Draw(Image.new('RGBA', (1, 1))).multiline_textbbox((0, 0), content, font = get_font(40), align = align)
+    # Centered lines can give fractional coordinates: round the box outwards to whole pixels
+    return int(left), int(top), int(right) + (right % 1 > 0), int(bottom) + (bottom % 1 > 0)
+
+
+def generate_text_image(songTitle, artistName, background, positionX = 50, positionY = 50):
     """
     Generate a text image with the song title and artist name.
+    The image is only as big as the text, and has to be pasted at the returned position.
     
     Args:
         songTitle (str): The title of the currently playing song.
         artistName (str): The name of the artist of the currently playing song.
-        colors (list): A list of two color objects.
-        display (tuple): The dimensions of the display.
+        background (Image): The image the text will be pasted on, used to choose the text color.
         positionX (int): The x-coordinate of the text.
         positionY (int): The y-coordinate of the text.
         
     Returns:
-        Image: A new image with the song title and artist name, and transparent background."""
-    width = int(display[0])
-    height = int(display[1])
-    # Setup Text: check if the first color is too light or too dark
-    textColor = colors[0].rgb
+        tuple: A new image with the song title and artist name and transparent background, and the (x, y) position where to paste it."""
+    content = songTitle + "\n" + artistName
+    #measure the text, so the image is only as big as needed
+    bbox = measure_text(content)
+    width, height = max(1, bbox[2]), max(1, bbox[3])
 
-    #if the color is too light, make the text black, otherwise make it white
-    if (textColor[0]*0.299 + textColor[1]*0.587 + textColor[2]*0.114) > 186:
-        textColor = (int(0), int(0), int(0))
-    else:
-        textColor = (int(255), int(255), int(255))
+    # Setup Text: check if the background under the text is too light or too dark
+    textColor = get_text_color(background, (positionX, positionY, positionX + width, positionY + height))
 
     #create a new image with the name of the song and the artist, and transparent background
     text = Image.new('RGBA', (width, height), (0, 0, 0, 0))
     #create a draw object
     draw = ImageDraw.Draw(text)
-    #set the font
-    myFont = ImageFont.truetype("./fonts/Rubik.ttf", 40)
     #draw the text
-    draw.text((positionX,positionY), (songTitle + "\n" + artistName), font = myFont, fill = (textColor[0],textColor[1],textColor[2]))
+    draw.text((0, 0), content, font = get_font(40), fill = textColor)
 
-    #save the text image
-    return text
+    return text, (positionX, positionY)
 
 
-def generate_centered_text_image(songTitle, artistName, colors, display):
+def generate_centered_text_image(songTitle, artistName, background, positionY):
     """
-    Generate a text image with the song title and artist name, centered on the display.
+    Generate a text image with the song title and artist name, horizontally centered on the background.
     
     Args:
         songTitle (str): The title of the currently playing song.
         artistName (str): The name of the artist of the currently playing song.
-        colors (list): A list of two color objects.
-        display (tuple): The dimensions of the display.
+        background (Image): The image the text will be pasted on, used to choose the text color.
+        positionY (int): The y-coordinate of the text.
         
     Returns:
-        Image: A new image with the song title and artist name, centered on the display."""
-    width = int(display[0])
-    height = int(display[1])
-    # Setup Text: check if the first color is too light or too dark
-    textColor = colors[0].rgb
+        tuple: A new image with the song title and artist name, and the (x, y) position where to paste it."""
+    content = songTitle + "\n" + artistName
+    #measure the text, so the image is only as big as needed
+    bbox = measure_text(content, align = "center")
+    width, height = max(1, bbox[2] - bbox[0]), max(1, bbox[3] - bbox[1])
+    positionX = background.width//2 - width//2
 
-    #if the color is too light, make the text black, otherwise make it white
-    if (textColor[0]*0.299 + textColor[1]*0.587 + textColor[2]*0.114) > 186:
-        textColor = (int(0), int(0), int(0))
-    else:
-        textColor = (int(255), int(255), int(255))
+    # Setup Text: check if the background under the text is too light or too dark
+    textColor = get_text_color(background, (positionX, positionY, positionX + width, positionY + height))
 
     #create a new image with the name of the song and the artist, and transparent background
     text = Image.new('RGBA', (width, height), (0, 0, 0, 0))
     #create a draw object
     draw = ImageDraw.Draw(text)
-    #set the font
-    myFont = ImageFont.truetype("./fonts/Rubik.ttf", 40)
-    #draw the text in the center of the display
-    draw.text((0,0), (songTitle + "\n" + artistName), font = myFont, fill = (textColor[0],textColor[1],textColor[2]), align="center")
-    #save the text image as 'text.png'
+    #draw the text, shifted so that it starts at the top-left corner of the image
+    draw.text((-bbox[0], -bbox[1]), content, font = get_font(40), fill = textColor, align="center")
 
-    cropped = text.crop(text.getbbox())
-    
-    return cropped
+    return text, (positionX, positionY)
+
+def save_final_image(image):
+    """
+    Save the generated wallpaper to final_image_path.
+    The wallpaper is overwritten at every song change, so the fastest zlib level is used
+    instead of the default one: the file is a bit bigger, but encoding is much faster.
+    The image is written to a temporary file and then renamed, so the wallpaper setter never reads a half-written file.
+
+    Args:
+        image (Image): The wallpaper to save.
+    """
+    with tempfile.NamedTemporaryFile(dir=runtime_dir, suffix=".tmp", delete=False) as temporary:
+        try:
+            image.save(temporary, format="PNG", compress_level=1)
+        except Exception:
+            temporary.close()
+            os.remove(temporary.name)
+            raise
+    os.replace(temporary.name, final_image_path)
 
-def paste_and_save_album_image(bg, cover, display, text):
+
+def paste_and_save_album_image(bg, cover, display, text, textPosition = (0, 0)):
     """
     Paste the album image in the center of the background image and save the final image.
 
     Args:
-        bg (Image): The background image.
+        bg (Image): The background image, in RGB mode and with the dimensions of the display.
         cover (Image): The album image.
         display (tuple): The dimensions of the display.
         text (Image): The text image.
+        textPosition (tuple): The (x, y) position where to paste the text image.
     """
 
-    width = int(display[0])
-    height = int(display[1])
     # Paste the album image, bigger of 120% of the size, in the center of the gradient image
     bg.paste(cover, ((int(bg.width/2) - int(cover.width / 2)), int((bg.height/2) - int(cover.height / 2))))
 
-    #save the final image
-
-    background = Image.new('RGB', (width, height))
-    background.paste(bg, (0, 0))
-    background.paste(text, (0, 0), mask = text)
-    background.save("ImageCache/finalImage.png")
+    #paste the text directly on the background and save the final image
+    bg.paste(text, textPosition, mask = text)
+    save_final_image(bg)
 
 
 
@@ -658,23 +810,19 @@ def calculate_gradient_color(radius, startRadius, endRadius, colors):
 
 def find_darkest_color(colors):
     """
-    Find the darkest color in a list of colors.
+    Find the brightest and the darkest color in a list of colors.
 
     Args:
         colors (list): A list of color objects.
 
     Returns:
-        Color:s: A list of color objects.
+        list: A list with the brightest color first and the darkest color second.
 
     """
-    #distance from black
-    distance1 = math.sqrt(colors[0].rgb[0]**2 + colors[0].rgb[1]**2 + colors[0].rgb[2]**2)
-    distance2 = math.sqrt(colors[1].rgb[0]**2 + colors[1].rgb[1]**2 + colors[1].rgb[2]**2)
+    #rank the whole palette by squared distance from black: the square root is not needed to compare distances
+    ranked = sorted(colors, key=lambda color: color.rgb[0]**2 + color.rgb[1]**2 + color.rgb[2]**2)
 
-    if distance1 > distance2:
-        return [colors[0], colors[1]]
-    else:
-        return [colors[1], colors[0]]
+    return [ranked[-1], ranked[0]]
 
 
 def generate_gradient_from_center(colors, display, albumImageWidth):
@@ -695,8 +843,8 @@ def generate_gradient_from_center(colors, display, albumImageWidth):
     # determine the number of ellipses to draw
     ellipses = 300
 
-    # Create a new image with the dimensions of the display
-    gradient = Image.new('RGB', (width, height))
+    # Get a black canvas with the dimensions of the display
+    gradient = get_canvas('RGB', width, height)
 
     # Create a draw object
     draw = ImageDraw.Draw(gradient)
@@ -749,16 +897,16 @@ def gradient(songTitle, imageUrl, artistName):
     if random.choice([True, False]):
         # Create a gradient image with the colors of the album image, starting from the top to the bottom
         gradient = generate_gradient_image(getColors(imageUrl), display)
-        text = generate_text_image(songTitle, artistName, getColors(imageUrl), display)
+        text, textPosition = generate_text_image(songTitle, artistName, gradient)
 
     else:
         # Create a gradient image with the colors of the album image, starting from the center to the edges
         gradient = generate_gradient_from_center(find_darkest_color(getColors(imageUrl)), display, albumImageWidth)
-        text = generate_text_image(songTitle, artistName, find_darkest_color(getColors(imageUrl)), display)
+        text, textPosition = generate_text_image(songTitle, artistName, gradient)
 
     #generate the text image
 
-    paste_and_save_album_image(gradient, image, display, text)
+    paste_and_save_album_image(gradient, image, display, text, textPosition)
 
 
 def resize_and_center_image(image, target_width, target_height):
@@ -775,19 +923,27 @@ def resize_and_center_image(image, target_width, target_height):
     """
     # Resize with preserved aspect ratio
     aspect_ratio = image.width / image.height
-    new_height = target_height
-    new_width = int(int(aspect_ratio) * int(new_height))
-    resized_image = image.resize((int(new_width), int(new_height)), Image.LANCZOS)
+    new_height = int(target_height)
+    new_width = int(round(aspect_ratio * new_height))
+
+    # LANCZOS cost grows with the size of the source, so let the cheap box filter of reduce() do most of a big downscale:
+    # shrink by the whole factor when it is an exact integer, otherwise to about 1.25 times the target first
+    ratio = image.height / new_height
+    if ratio >= 2 and image.height % new_height == 0:
+        image = image.reduce(image.height // new_height)
+    elif ratio > 3:
+        image = image.reduce(int(ratio / 1.25))
 
     target_width = int(target_width)
-    # Center the image vertically
+    # Center the image horizontally: if it is too wide, resize only the central region of the source,
+    # so LANCZOS does not compute columns that would be cropped away
     if new_width > target_width:
-        x_offset = (new_width - target_width) // 2
-        resized_and_centered_image = resized_image.crop((x_offset, 0, x_offset + target_width, new_height))
-    else:
-        resized_and_centered_image = resized_image
+        scale = new_height / image.height
+        source_crop_width = target_width / scale
+        x_offset = max(0, (image.width - source_crop_width) / 2)
+        return image.resize((target_width, new_height), Image.LANCZOS, box=(x_offset, 0, min(image.width, x_offset + source_crop_width), image.height))
 
-    return resized_and_centered_image
+    return image.resize((new_width, new_height), Image.LANCZOS)
 
 
 def create_blurred_background(cover_image_data, display_dimensions, blur_radius=20):
@@ -843,8 +999,7 @@ def blurred(cover_url, display_dimensions):
 
     final_image = create_blurred_background(cover_image_data, display_dimensions)
     if final_image:
-        final_image_path = "ImageCache/finalImage.png"
-        final_image.save(final_image_path)
+        save_final_image(final_image)
         return True
     else:
         print("Failed to create blurred background.")
@@ -872,14 +1027,17 @@ def get_audio_analysis(song_id):
         "Content-Type": "application/json",
         "Authorization": f"Bearer {spotify_token}"
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-
-        print("Error during request")
+    try:
+        response = session.get(url, headers=headers, timeout=10)
+        if response.status_code == 200:
+            return orjson.loads(response.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        print(f"Error during request: {e}")
         return None
 
+    print("Error during request")
+    return None
+
 def extract_loudness_data(audio_analysis, duration, sample_points=100):
     """
     Extracts loudness data from the audio analysis.
@@ -959,7 +1117,7 @@ def generate_waveform_image(levels, display_dimensions, colors):
 
 
 
-def waveform(song_id, display, imageUrl, artistName, songTitle):
+def waveform(song_id, display, imageUrl, artistName, songTitle, audio_analysis):
     """
     Generate a wallpaper with a waveform based on the audio analysis of the song.
 
@@ -969,13 +1127,13 @@ def waveform(song_id, display, imageUrl, artistName, songTitle):
         imageUrl (str): The URL of the song's cover image.
         artistName (str): The name of the artist of the currently playing song.
         songTitle (str): The title of the currently playing song.
+        audio_analysis (dict): The audio analysis of the song, already retrieved by get_audio_analysis; None if the request failed.
 
     Returns:
         None: The generated wallpaper is saved to the 'ImageCache' directory.
     """
 
-    # Get audio analysis for the song
-    audio_analysis = get_audio_analysis(song_id)
+    # The audio analysis is fetched concurrently with the cover, so a failed request is not repeated here
     if audio_analysis is None:
         print("Failed to retrieve audio analysis.")
         return
@@ -987,17 +1145,17 @@ def waveform(song_id, display, imageUrl, artistName, songTitle):
     
     # Generate the waveform image
     waveform_image = generate_waveform_image(loudness, (int(width), int(height)), getColors(imageUrl))
-    # Generate the text image in the low-left corner
-    text_image = generate_text_image(songTitle, artistName, getColors(imageUrl), display, positionX=50, positionY=int(height) - 150)
     # Create a new image with the first color of the album image as the background
-    final_image = Image.new('RGB', (int(width), int(height)), getColors(imageUrl)[0].rgb)
+    final_image = get_canvas('RGB', int(width), int(height), getColors(imageUrl)[0].rgb)
     # Paste the waveform image in the center of the background image, centered vertically and horizontally
     final_image.paste(waveform_image, ((int(final_image.width/2) - int(waveform_image.width / 2)), int((final_image.height/2) - int(waveform_image.height / 2))))
+    # Generate the text image in the low-left corner
+    text_image, text_position = generate_text_image(songTitle, artistName, final_image, positionX=50, positionY=int(height) - 150)
     # Paste the text image 
-    final_image.paste(text_image, (0, 0), mask=text_image)
+    final_image.paste(text_image, text_position, mask=text_image)
 
     # Save the image
-    final_image.save("ImageCache/finalImage.png")
+    save_final_image(final_image)
 
 
 def fillWithSecondaryColor(color, width, height):
@@ -1059,13 +1217,13 @@ def drawController(songDetails, display, imageUrl):
     displaySize = (int(display[0]), int(display[1]))
 
     #create a new image with the dimensions of the display
-    controllerImage = Image.new('RGBA', displaySize, backgroundColor)
+    controllerImage = get_canvas('RGBA', displaySize[0], displaySize[1], backgroundColor)
 
     #create a draw object
     draw = ImageDraw.Draw(controllerImage)
 
     #set the font
-    myFont = ImageFont.truetype("./fonts/Rubik.ttf", 40)
+    myFont = get_font(40)
 
     #put the album image horizontally centered, 30% from the top
     albumImage = setup_album_image(display, imageUrl)
@@ -1077,9 +1235,9 @@ def drawController(songDetails, display, imageUrl):
     pauseButton = Image.open("ImageCache/pause-button.png").convert("RGBA")
 
     #generate the text image just below the album image
-    text = generate_centered_text_image(songTitle, artistName, getColors(imageUrl), display)
+    text, textPosition = generate_centered_text_image(songTitle, artistName, controllerImage, displaySize[1]//6 + albumImage.height + 50)
     #paste the text image just below the album image, horizontally centered
-    controllerImage.paste(text, (displaySize[0]//2 - text.width//2, displaySize[1]//6 + albumImage.height + 50), mask=text)
+    controllerImage.paste(text, textPosition, mask=text)
     
     #paste it horizontally centered, 60% from the top
     controllerImage.paste(pauseButton, (displaySize[0]//2 - pauseButton.width//2, displaySize[1]//6 + albumImage.height + 250), mask=pauseButton)
@@ -1104,7 +1262,7 @@ def drawController(songDetails, display, imageUrl):
     #TODO: add the "next" and "previous" buttons
 
     #save the image
-    controllerImage.save("ImageCache/finalImage.png")
+    save_final_image(controllerImage)
 
 
 def changeWallpaper():
@@ -1118,8 +1276,16 @@ def changeWallpaper():
 
     while True:
         
-        #check if the song has been paused
-        song_details = get_song_details(spotify_token)
+        #choose randomly between the different modes, used if the song has changed
+        mode = random.choice(modes)
+
+        #check if the song has been paused; the blurred mode draws the cover at its own size and
+        #stretches it over the whole background, so it always needs the largest album image
+        try:
+            song_details = get_song_details(ensure_token(), coverWidth=math.inf if mode == "blurred" else None)
+        except requests.exceptions.RequestException:
+            # The token refresh couldn't reach Spotify
+            song_details = None
         if song_details is None:
             print("Failed to retrieve song details. Trying again...")
             time.sleep(5)  # Wait a bit before retrying
@@ -1135,19 +1301,20 @@ def changeWallpaper():
         if status == "playing" and prev_status == "paused":
             #if the song has been paused and then resumed, change the wallpaper
             prev_status = "playing"
-            os.system(command + os.getcwd() + "/ImageCache/finalImage.png")
+            os.system(command + final_image_path)
             time.sleep(5)
             continue
         if songId != checkSong() or modes != oldModes:
             oldModes = modes
-            # Download the image and get its local path
-            download_image(imageUrl)
+            # Download the image, and at the same time the audio analysis if the waveform mode needs it
+            coverDownload = executor.submit(download_image, imageUrl)
+            audioAnalysis = executor.submit(get_audio_analysis, songId) if mode == "waveform" else None
             #change the song title in the file
             with open("src/songCheck.txt", "w") as f:
                 f.write(songId)
                 f.close()
-            #choose randomly between the different modes, and generate the wallpaper
-            mode = random.choice(modes)
+            coverDownload.result()
+            #generate the wallpaper
             if mode == "gradient":
                 gradient(songTitle, imageUrl, artistName)
             elif mode == "blurred":
@@ -1156,13 +1323,13 @@ def changeWallpaper():
                     resetSong()
                     continue
             elif mode == "waveform":
-                waveform(songId, display, imageUrl, artistName, songTitle)
+                waveform(songId, display, imageUrl, artistName, songTitle, audioAnalysis.result())
             elif mode == "albumImage":
                 albumImage(display, songTitle, artistName, imageUrl)
             elif mode == "controllerImage":
                 drawController(song_details, display, imageUrl)
             #change the wallpaper                           
-            os.system(command + os.getcwd() + "/ImageCache/finalImage.png")
+            os.system(command + final_image_path)
         time.sleep(1)  
     
 
@@ -1267,6 +1434,11 @@ if __name__ == "__main__":
 
         os.system(command + str(original_wallpaper))
         resetSong()
+        #the wallpaper has been restored, so the temporary directory created for this run is not needed anymore
+        if runtime_dir_is_temporary:
+            shutil.rmtree(runtime_dir, ignore_errors=True)
+        executor.shutdown(wait=False)
+        session.close()
         print("Wallpaper restored.")
         
         pid = os.getpid()